@@ -1,10 +1,19 @@
 # main.py
 import os
 import re
+import asyncio
 import logging
-from fastapi import FastAPI, HTTPException
-from pydantic import BaseModel
+import threading
+from collections.abc import AsyncIterator, Callable, Coroutine
+from dataclasses import dataclass
+from typing import Any
+from fastapi import FastAPI, HTTPException, Request, Response
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from fastapi.routing import APIRoute
+from pydantic import BaseModel, Field
 import uvicorn
+import orjson
+import ahocorasick
 import google.generativeai as genai # New import for Google Gemini
 
 # --- Configuration and Initialization ---
@@ -15,12 +24,38 @@ logging.basicConfig(
     format='%(asctime)s - %(levelname)s - %(message)s'
 )
 
+class ORJSONRequest(Request):
+    """
+    Request whose JSON body is parsed with orjson instead of the stdlib json module.
+    orjson.JSONDecodeError subclasses json.JSONDecodeError, so FastAPI still reports
+    malformed bodies as validation errors.
+    """
+    async def json(self) -> Any:
+        if not hasattr(self, "_json"):
+            self._json = orjson.loads(await self.body())
+        return self._json
+
+class ORJSONRoute(APIRoute):
+    """
+    Route that hands endpoints an ORJSONRequest so request bodies are decoded with orjson.
+    """
+    def get_route_handler(self) -> Callable[[Request], Coroutine[Any, Any, Response]]:
+        original_route_handler = super().get_route_handler()
+
+        async def orjson_route_handler(request: Request) -> Response:
+            return await original_route_handler(ORJSONRequest(request.scope, request.receive))
+
+        return orjson_route_handler
+
 # Initialize FastAPI app
 app = FastAPI(
     title="Gemini-Powered AI Assistant with Filtering",
     description="A FastAPI-based AI assistant filtering commands and using Google Gemini for responses.",
-    version="1.0.0"
+    version="1.0.0",
+    default_response_class=ORJSONResponse
 )
+# Must be set before any routes are registered
+app.router.route_class = ORJSONRoute
 
 # Initialize Google Gemini client.
 # It automatically reads GOOGLE_API_KEY from environment variables.
@@ -52,88 +87,218 @@ if api_key:
 # File path for allowed commands list
 ALLOWED_COMMANDS_FILE = "allowed_commands.txt"
 
+# Strips everything except lowercase letters, digits and whitespace when normalizing queries
+_NON_ALNUM_RE = re.compile(r'[^a-z0-9\s]')
+
+# Pre-serialized response returned for every blocked request
+BLOCKED_RESPONSE = ORJSONResponse({"response": "Command not allowed."})
+
+# Appended to a streamed AI response if Gemini fails after streaming has started
+STREAM_ERROR_MARKER = "\n\n[Error: the AI backend failed while generating this response. Please try again later.]"
+
 # --- Pydantic Models ---
 
 # Defines the structure for incoming POST requests
 class ChatRequest(BaseModel):
-    message: str
+    message: str = Field(min_length=1, max_length=4000)
 
 # --- Helper Functions (Command Filtering) ---
 
-def load_allowed_commands(file_path: str) -> set[str]:
+@dataclass(frozen=True)
+class AllowedCommands:
+    """
+    Parsed contents of an allowed-commands file, split at load time so
+    the per-request checks never have to re-scan commands for spaces.
+    """
+    singles: frozenset[str]  # Commands without spaces, matched against query tokens
+    multi_word_matcher: ahocorasick.Automaton | None  # Matches any multi-word command as a substring
+    whole: frozenset[str]  # Every command, for exact matches on the normalized query
+
+NO_ALLOWED_COMMANDS = AllowedCommands(singles=frozenset(), multi_word_matcher=None, whole=frozenset())
+
+# Cache of parsed allowed-commands files, keyed by path.
+# Each entry holds ((st_mtime_ns, st_size), AllowedCommands) so the file is only
+# re-parsed (and the multi-word automaton only rebuilt) when it changes.
+_cmd_cache: dict[str, tuple[tuple[int, int], AllowedCommands]] = {}
+_cmd_cache_lock = threading.Lock()
+
+# Signature recorded for a missing file, so "not found" is cached like any other result
+_FILE_NOT_FOUND = (-1, -1)
+
+def build_multi_word_matcher(phrases: list[str]) -> ahocorasick.Automaton | None:
+    """
+    Builds an Aho-Corasick automaton over the given multi-word commands, so a query can be
+    checked for any of them in a single O(len(query)) pass regardless of list size.
+    Returns None if there are no phrases.
+    """
+    if not phrases:
+        return None
+    automaton = ahocorasick.Automaton()
+    for phrase in phrases:
+        automaton.add_word(phrase, phrase)
+    automaton.make_automaton()
+    return automaton
+
+def get_file_signature(file_path: str) -> tuple[int, int] | None:
     """
-    Loads allowed commands from a plain text file.
-    This function is called for each request to ensure immediate reflection of changes
-    in the allowed_commands.txt file without requiring a server restart.
+    Returns (st_mtime_ns, st_size) for `file_path`, _FILE_NOT_FOUND if it does not exist,
+    or None if it cannot be stat'ed for any other reason.
     """
-    allowed_commands = set()
     try:
-        if os.path.exists(file_path):
+        st = os.stat(file_path)
+    except FileNotFoundError:
+        return _FILE_NOT_FOUND
+    except OSError:
+        return None
+    return st.st_mtime_ns, st.st_size
+
+def get_cached_allowed_commands(file_path: str, signature: tuple[int, int] | None) -> AllowedCommands | None:
+    """
+    Returns the cached commands for `file_path` if they were parsed from a file with the
+    given signature (see `get_file_signature`), otherwise None. Does no I/O, so it is safe
+    to call directly on the event loop.
+    """
+    cached = _cmd_cache.get(file_path)
+    if cached is not None and signature is not None and cached[0] == signature:
+        return cached[1]
+    return None
+
+def load_allowed_commands(file_path: str, signature: tuple[int, int] | None = None) -> AllowedCommands:
+    """
+    Loads allowed commands from a plain text file, split into single-word commands,
+    an Aho-Corasick automaton over the multi-word commands, and the full set.
+    The result is cached and only reloaded when the file's mtime or size changes, so edits
+    to allowed_commands.txt are still reflected immediately without requiring a server restart.
+    Pass `signature` if the caller has already stat'ed the file.
+    """
+    if signature is None:
+        signature = get_file_signature(file_path)
+    cached = get_cached_allowed_commands(file_path, signature)
+    if cached is not None:
+        return cached
+
+    if signature == _FILE_NOT_FOUND:
+        logging.warning(f"Allowed commands file '{file_path}' not found. No commands will be allowed initially.")
+        allowed_commands = NO_ALLOWED_COMMANDS
+    else:
+        commands = set()
+        try:
             with open(file_path, 'r', encoding='utf-8') as f:
                 for line in f:
                     command = line.strip().lower()
                     if command:
-                        allowed_commands.add(command)
-            logging.info(f"Loaded {len(allowed_commands)} allowed commands from {file_path} for current request.")
-        else:
-            logging.warning(f"Allowed commands file '{file_path}' not found. No commands will be allowed initially.")
-    except Exception as e:
-        logging.error(f"Error loading allowed commands from '{file_path}': {e}. No commands will be allowed.")
+                        commands.add(command)
+        except Exception as e:
+            logging.error(f"Error loading allowed commands from '{file_path}': {e}. No commands will be allowed.")
+            return NO_ALLOWED_COMMANDS
+
+        allowed_commands = AllowedCommands(
+            singles=frozenset(c for c in commands if ' ' not in c),
+            multi_word_matcher=build_multi_word_matcher([c for c in commands if ' ' in c]),
+            whole=frozenset(commands),
+        )
+        logging.info(f"Loaded {len(allowed_commands.whole)} allowed commands from {file_path}.")
+
+    if signature is not None:
+        with _cmd_cache_lock:
+            _cmd_cache[file_path] = (signature, allowed_commands)
     return allowed_commands
 
-def is_query_allowed(query: str, allowed_commands: set[str]) -> bool:
+def normalize_query(query: str) -> tuple[str, str, frozenset[str]]:
+    """
+    Normalizes a user query once per request.
+    Returns (query_lower, normalized_query, tokens), where `normalized_query` has
+    everything but letters, digits and whitespace stripped and `tokens` are its words.
+    """
+    query_lower = query.lower()
+    normalized_query = _NON_ALNUM_RE.sub('', query_lower)
+    return query_lower, normalized_query, frozenset(normalized_query.split())
+
+def is_query_allowed(
+    query_lower: str,
+    normalized_query: str,
+    tokens: frozenset[str],
+    allowed_commands: AllowedCommands,
+) -> bool:
     """
     Checks if the user's query contains at least one significant keyword or phrase
-    from the `allowed_commands` list. Matching is case-insensitive.
+    from the `allowed_commands` list. Matching is case-insensitive; the query must
+    already be normalized with `normalize_query`.
     """
-    if not allowed_commands:
+    if not allowed_commands.whole:
         logging.warning("No allowed commands loaded; therefore, no queries are permitted.")
         return False
 
-    query_lower = query.lower()
-    normalized_query = re.sub(r'[^a-z0-9\s]', '', query_lower)
-    normalized_query_words = set(normalized_query.split())
-
-    # Check for multi-word phrases first
-    for command in allowed_commands:
-        if ' ' in command:
-            if command in query_lower:
-                logging.debug(f"Query allowed by multi-word command match: '{command}' found in '{query}'")
-                return True
-
-    # Check for individual words or single-word commands
-    for word in normalized_query_words:
-        if word in allowed_commands:
-            logging.debug(f"Query allowed by single-word command match: '{word}' found in '{query}'")
-            return True
+    # Check for individual words or single-word commands first (one hashed set intersection)
+    matched_words = tokens & allowed_commands.singles
+    if matched_words:
+        logging.debug(f"Query allowed by single-word command match: {sorted(matched_words)} found in '{query_lower}'")
+        return True
 
     # Check if the entire (normalized) query itself is an allowed command
-    if normalized_query in allowed_commands:
+    if normalized_query in allowed_commands.whole:
         logging.debug(f"Query allowed by exact normalized query match: '{normalized_query}'")
         return True
 
-    logging.info(f"Query '{query}' did not contain any allowed commands or keywords.")
+    # Only then scan for multi-word phrases
+    if allowed_commands.multi_word_matcher is not None:
+        for _, command in allowed_commands.multi_word_matcher.iter(query_lower):
+            logging.debug(f"Query allowed by multi-word command match: '{command}' found in '{query_lower}'")
+            return True
+
+    logging.info(f"Query '{query_lower}' did not contain any allowed commands or keywords.")
     return False
 
+async def stream_gemini_response(first_chunk, chunks: AsyncIterator, user_message: str) -> AsyncIterator[str]:
+    """
+    Yields the generated text of a streamed Gemini response chunk by chunk,
+    starting with the already-validated `first_chunk`.
+    Once streaming has started the status code is already sent, so errors are
+    logged and reported to the client by appending STREAM_ERROR_MARKER.
+    """
+    yield first_chunk.text
+    try:
+        async for chunk in chunks:
+            if chunk.parts:
+                yield chunk.text
+        logging.info(f"Successfully processed allowed request for: '{user_message}'")
+    except Exception as e:
+        logging.error(f"Error streaming Google Gemini response for '{user_message}': {e}", exc_info=True)
+        yield STREAM_ERROR_MARKER
+
 # --- FastAPI Endpoint ---
 
 @app.post("/chat")
 async def chat_endpoint(request: ChatRequest):
     """
     Handles incoming chat requests:
-    1. Loads allowed commands from 'allowed_commands.txt'.
+    1. Loads allowed commands from 'allowed_commands.txt' (re-parsed off the event loop only when the file changes).
     2. Checks if the user's message is allowed based on the loaded commands.
     3. If allowed, forwards the message to Google Gemini for response generation.
-    4. Returns the AI's response or a "Command not allowed" message.
+    4. Streams the AI's response back as plain text, or returns a "Command not allowed" message.
+
+    Note the response contract differs by outcome, so clients should branch on Content-Type:
+    - Allowed: `text/plain` stream of the AI's answer. If Gemini fails mid-stream, the body
+      ends with STREAM_ERROR_MARKER (the 200 status has already been sent).
+    - Blocked: `application/json` {"response": "Command not allowed."}.
+    - Invalid body (422) or backend failure before streaming (500): `application/json` {"detail": ...}.
     """
     user_message = request.message
 
+    # Reject whitespace-only messages before doing any filtering work
+    if not user_message.strip():
+        return BLOCKED_RESPONSE
+
     # Step 1: Check the query against allowed_commands.txt
-    allowed_commands = load_allowed_commands(ALLOWED_COMMANDS_FILE)
+    signature = get_file_signature(ALLOWED_COMMANDS_FILE)
+    allowed_commands = get_cached_allowed_commands(ALLOWED_COMMANDS_FILE, signature)
+    if allowed_commands is None:
+        allowed_commands = await asyncio.to_thread(load_allowed_commands, ALLOWED_COMMANDS_FILE, signature)
 
-    if not is_query_allowed(user_message, allowed_commands):
+    query_lower, normalized_query, tokens = normalize_query(user_message)
+    if not is_query_allowed(query_lower, normalized_query, tokens, allowed_commands):
         logging.info(f"Blocked request: '{user_message}' - Command not allowed.")
-        return {"response": "Command not allowed."}
+        return BLOCKED_RESPONSE
 
     # Step 2: If allowed, process with Google Gemini API
     if gemini_model is None:
@@ -159,9 +324,11 @@ async def chat_endpoint(request: ChatRequest):
         # For simple text generation, a combined prompt works well.
         full_prompt = f"{system_prompt}\n\nUser Query: {user_message}"
 
-        # Make the request to Gemini API
-        response = gemini_model.generate_content(
+        # Make the request to Gemini API without blocking the event loop,
+        # streaming tokens back as they are generated
+        response = await gemini_model.generate_content_async(
             full_prompt,
+            stream=True,
             safety_settings={
                 "HARASSMENT": "BLOCK_NONE",
                 "HATE": "BLOCK_NONE",
@@ -174,9 +341,16 @@ async def chat_endpoint(request: ChatRequest):
             )
         )
 
-        ai_response = response.text # Get the generated text content
-        logging.info(f"Successfully processed allowed request for: '{user_message}'")
-        return {"response": ai_response}
+        # The SDK has already received the first chunk, so blocked prompts and empty
+        # (e.g. safety-stopped) responses can still be turned into a 500 here
+        if response.prompt_feedback.block_reason:
+            raise ValueError(f"Prompt was blocked by Gemini: {response.prompt_feedback}")
+        chunks = aiter(response)
+        first_chunk = await anext(chunks)
+        if not first_chunk.parts:
+            raise ValueError(f"Gemini returned no content: {first_chunk.candidates}")
+
+        return StreamingResponse(stream_gemini_response(first_chunk, chunks, user_message), media_type="text/plain")
 
     except Exception as e:
         logging.error(f"Error processing Google Gemini request for '{user_message}': {e}", exc_info=True)
@@ -188,4 +362,6 @@ if __name__ == "__main__":
     # To run locally, ensure you have set your GOOGLE_API_KEY environment variable.
     # Example (in bash/zsh): export GOOGLE_API_KEY="your_actual_gemini_api_key_here"
     logging.info("Starting FastAPI application for local development on http://0.0.0.0:8000")
-    uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+    # uvicorn[standard] makes uvicorn pick uvloop/httptools automatically where available.
+    # The worker count comes from WEB_CONCURRENCY (default 1); multiple workers need the app as an import string.
+    uvicorn.run("main:app", host="0.0.0.0", port=8000)
\ No newline at end of file